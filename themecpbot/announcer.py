@@ -0,0 +1,92 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, List, Tuple
+
+import discord
+from table2ascii import table2ascii, Alignment
+
+import themecp
+import database as db
+import metrics
+
+CACHE_SIZE = 1024
+ANNOUNCE_CONCURRENCY = 5
+
+
+def build_results(contest: db.VirtualContest):
+    penalties = contest.get_penalties()
+    table = table2ascii(
+        header=['#', 'Name', 'Rating', 'Penalty'],
+        body=[
+            [num, problem.problem_info.name, problem.problem_info.rating,
+                penalty if penalty != -1 else 'N/A']
+            for num, (problem, penalty) in enumerate(zip(contest.problems, penalties), 1)
+        ],
+        alignments=[Alignment.LEFT, Alignment.LEFT,
+                    Alignment.LEFT, Alignment.LEFT]
+    )
+    performance = themecp.compute_performance(
+        contest.level, [problem.problem_info.rating for problem in contest.problems], penalties)
+    return f'```{table}\nPerformance: {performance}\n```'
+
+
+class EntityCache:
+    def __init__(self, get: Callable[[int], Any], fetch: Callable[[int], Awaitable[Any]], size: int = CACHE_SIZE):
+        self.get = get
+        self.fetch = fetch
+        self.size = size
+        self.entities: OrderedDict[int, Any] = OrderedDict()
+
+    async def resolve(self, entity_id: int):
+        entity = self.get(entity_id)
+        if entity is not None:
+            metrics.increment('announcer.gateway_cache_hits')
+            return entity
+        entity = self.entities.get(entity_id)
+        if entity is not None:
+            metrics.increment('announcer.lru_hits')
+            self.entities.move_to_end(entity_id)
+            return entity
+
+        metrics.increment('announcer.fetches')
+        entity = await self.fetch(entity_id)
+        self.entities[entity_id] = entity
+        if len(self.entities) > self.size:
+            self.entities.popitem(last=False)
+        return entity
+
+
+class Announcer:
+    def __init__(self, client: discord.Client):
+        self.client = client
+        self.users = EntityCache(client.get_user, client.fetch_user)
+        self.channels = EntityCache(client.get_channel, client.fetch_channel)
+        self.semaphore = asyncio.Semaphore(ANNOUNCE_CONCURRENCY)
+
+    async def get_user_and_channel(self, user_id: int, channel_id: int):
+        return await asyncio.gather(self.users.resolve(user_id), self.channels.resolve(channel_id))
+
+    async def announce_all(self, finished: List[Tuple[db.VirtualContest, bool]]):
+        results = await asyncio.gather(*(self.announce(contest, solved_all) for contest, solved_all in finished),
+                                       return_exceptions=True)
+        for (contest, _), result in zip(finished, results):
+            if isinstance(result, Exception):
+                logging.error('Failed to announce contest %d', contest.virtual_contest_id, exc_info=result)
+
+    async def announce(self, contest: db.VirtualContest, solved_all: bool):
+        async with self.semaphore:
+            if solved_all:
+                await self.contest_success(contest)
+            else:
+                await self.contest_fail(contest)
+
+    async def contest_success(self, contest: db.VirtualContest):
+        user, channel = await self.get_user_and_channel(contest.user_id, contest.channel_id)
+        results = build_results(contest)
+        await channel.send(f"Yay! {user.mention}\n{results}")
+
+    async def contest_fail(self, contest: db.VirtualContest):
+        user, channel = await self.get_user_and_channel(contest.user_id, contest.channel_id)
+        results = build_results(contest)
+        await channel.send(f"Time's up! {user.mention}\n{results}")
@@ -0,0 +1,226 @@
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+import types
+from collections import Counter
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import List
+
+from sqlalchemy import event
+
+SCENARIOS = ['start', 'checker', 'identify']
+
+
+def percentile(values: List[float], fraction: float):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class LoopStallProbe:
+    def __init__(self, interval: float = 0.01, threshold: float = 0.05):
+        self.interval = interval
+        self.threshold = threshold
+        self.lags: List[float] = []
+        self.task: asyncio.Task | None = None
+
+    async def run(self):
+        while True:
+            expected = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, time.perf_counter() - expected))
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        self.task.cancel()
+        stalls = [lag for lag in self.lags if lag >= self.threshold]
+        return {'max_lag': max(self.lags, default=0.0), 'stalls': len(stalls), 'stall_time': sum(stalls)}
+
+
+class Scenario:
+    def __init__(self, name: str, fake, engine):
+        self.name = name
+        self.fake = fake
+        self.engine = engine
+        self.latencies: List[float] = []
+        self.round_trips = 0
+
+    def count_round_trip(self, *args):
+        self.round_trips += 1
+
+    async def __aenter__(self):
+        event.listen(self.engine.sync_engine, 'before_cursor_execute', self.count_round_trip)
+        self.calls = Counter(self.fake.calls)
+        self.throttled = self.fake.throttled
+        self.probe = LoopStallProbe()
+        self.probe.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        stall = self.probe.stop()
+        event.remove(self.engine.sync_engine, 'before_cursor_execute', self.count_round_trip)
+        calls = Counter(self.fake.calls)
+        calls.subtract(self.calls)
+        print(f'== {self.name}')
+        print(f'  samples      {len(self.latencies)}')
+        print(f'  p50 / p99    {percentile(self.latencies, 0.5) * 1000:.1f} ms / '
+              f'{percentile(self.latencies, 0.99) * 1000:.1f} ms')
+        print(f'  api calls    {dict(+calls)} (throttled {self.fake.throttled - self.throttled})')
+        print(f'  db trips     {self.round_trips}')
+        print(f'  loop stalls  {stall["stalls"]} totalling {stall["stall_time"] * 1000:.1f} ms '
+              f'(max lag {stall["max_lag"] * 1000:.1f} ms)')
+
+
+async def bench_start(args, fake, modules):
+    db, themecp = modules.db, modules.themecp
+    for user_id in range(args.starts):
+        await db.User.create(user_id, f'start{user_id}')
+
+    async def start(user_id: int):
+        begin = time.perf_counter()
+        try:
+            tag, problems = await themecp.choose_problems(f'start{user_id}', args.level)
+        except themecp.NotEnoughProblemsException:
+            return time.perf_counter() - begin
+        await db.create_contest_with_problems(user_id, tag, 0, args.level, problems)
+        return time.perf_counter() - begin
+
+    async with Scenario(f'{args.starts} concurrent starts', fake, db.engine) as scenario:
+        scenario.latencies = await asyncio.gather(*(start(user_id) for user_id in range(args.starts)))
+
+
+async def bench_checker(args, fake, modules):
+    codeforces, db, checker = modules.codeforces, modules.db, modules.checker
+    offset = 10 ** 6
+    for number in range(args.contests):
+        user_id = offset + number
+        handle = f'checker{number}'
+        await db.User.create(user_id, handle)
+        chosen = random.sample(fake.problems[:args.shared or len(fake.problems)], 4)
+        await db.create_contest_with_problems(
+            user_id, 'math', 0, 1, [codeforces.Problem(problem) for problem in chosen])
+        for problem in chosen[:random.randrange(5)]:
+            fake.submit(handle, problem, creation_time=int(time.time()) + 1)
+
+    event_journal = modules.journal.EventJournal(Path(os.environ['BENCH_FOLDER']).joinpath('journal.jsonl'))
+    event_journal.open()
+    solved_checker = checker.SolvedChecker(event_journal)
+    async with Scenario(f'{args.contests} active contests x {args.ticks} ticks', fake, db.engine) as scenario:
+        for _ in range(args.ticks):
+            begin = time.perf_counter()
+            finished = await solved_checker.tick()
+            await event_journal.record_finishes([contest for contest, _ in finished])
+            await event_journal.flush()
+            scenario.latencies.append(time.perf_counter() - begin)
+    event_journal.close()
+
+
+async def bench_identify(args, fake, modules):
+    identifier = modules.identifier
+    cog = identifier.Identifier()
+    await cog.cog_load()
+    watermelon = {'contestId': 4, 'index': 'A', 'name': 'Watermelon', 'rating': 800}
+    submitted = {}
+    identified = {}
+
+    def make_ctx(user_id: int):
+        async def send(content=None, **kwargs):
+            if content is not None and 'successfully identified' in content:
+                identified[user_id] = time.perf_counter()
+        author = types.SimpleNamespace(id=user_id, mention=f'<@{user_id}>')
+        message = types.SimpleNamespace(created_at=datetime.now(timezone.utc))
+        return types.SimpleNamespace(author=author, message=message, send=send)
+
+    async def identify(user_id: int):
+        handle = f'identify{user_id}'
+        await identifier.Identifier.identify.callback(cog, make_ctx(user_id), handle)
+        await asyncio.sleep(random.uniform(1, 10))
+        fake.submit(handle, watermelon, verdict='COMPILATION_ERROR', creation_time=int(time.time()) + 1)
+        submitted[user_id] = time.perf_counter()
+
+    offset = 2 * 10 ** 6
+    async with Scenario(f'{args.identifies} pending identifies', fake, modules.db.engine) as scenario:
+        await asyncio.gather(*(identify(offset + number) for number in range(args.identifies)))
+        deadline = time.perf_counter() + identifier.IDENTIFY_TIMEOUT
+        while cog.pending and time.perf_counter() < deadline:
+            await asyncio.sleep(0.1)
+        scenario.latencies = [identified[user_id] - submitted[user_id] for user_id in identified]
+
+    print(f'  identified   {len(identified)} of {args.identifies}')
+    await cog.cog_unload()
+
+
+async def run(args):
+    import codeforces
+    import checker
+    import database as db
+    import identifier
+    import journal
+    import metrics
+    import problemset
+    import ratelimiter
+    import themecp
+    from fakecodeforces import FakeCodeforces
+
+    fake = FakeCodeforces(problem_count=args.problems, history_size=args.history,
+                          latency=args.latency, rate=args.server_rate, burst=args.server_burst,
+                          error_rate=args.server_errors)
+    codeforces.CODEFORCES_API_URL = await fake.start()
+    codeforces.limiter = ratelimiter.RateLimiter(args.api_rate)
+    problemset.cache = problemset.ProblemsetCache(path=Path(os.environ['BENCH_FOLDER']).joinpath('problemset.json'))
+    await db.init()
+
+    modules = types.SimpleNamespace(codeforces=codeforces, checker=checker, db=db,
+                                    identifier=identifier, journal=journal, themecp=themecp)
+    try:
+        if 'start' in args.scenarios:
+            await bench_start(args, fake, modules)
+        if 'checker' in args.scenarios:
+            await bench_checker(args, fake, modules)
+        if 'identify' in args.scenarios:
+            await bench_identify(args, fake, modules)
+        print('== hot path timings')
+        print(metrics.render())
+    finally:
+        await codeforces.close()
+        await db.engine.dispose()
+        await fake.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark ThemeCP bot hot paths against a fake Codeforces API')
+    parser.add_argument('--scenario', dest='scenarios', action='append', choices=SCENARIOS)
+    parser.add_argument('--starts', type=int, default=10)
+    parser.add_argument('--level', type=int, default=30)
+    parser.add_argument('--contests', type=int, default=50)
+    parser.add_argument('--ticks', type=int, default=3)
+    parser.add_argument('--shared', type=int, default=0,
+                        help='draw checker contests from only this many problems, so handles share them')
+    parser.add_argument('--identifies', type=int, default=10)
+    parser.add_argument('--problems', type=int, default=9000)
+    parser.add_argument('--history', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--api-rate', type=float, default=20)
+    parser.add_argument('--server-rate', type=float, default=25)
+    parser.add_argument('--server-burst', type=int, default=25)
+    parser.add_argument('--server-errors', type=float, default=0.0, help='fraction of calls answered with a 502')
+    args = parser.parse_args()
+    args.scenarios = args.scenarios or SCENARIOS
+
+    # Bot modules read their configuration at import time.
+    folder = tempfile.mkdtemp(prefix='themecpbot-bench-')
+    os.environ['BENCH_FOLDER'] = folder
+    os.environ['DATABASE_URL'] = f'sqlite:///{folder}/bench.db'
+    random.seed(0)
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
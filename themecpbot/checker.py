@@ -0,0 +1,203 @@
+import asyncio
+import logging
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Tuple
+
+import codeforces
+import database as db
+import metrics
+import ratelimiter
+import solved
+from announcer import Announcer
+from journal import EventJournal
+
+CONTEST_LENGTH = timedelta(hours=2)
+TICK_INTERVAL = 15
+HOT_INTERVAL = 15
+IDLE_INTERVAL = 60
+HOT_WINDOW = 10 * 60
+FAILURE_GRACE = timedelta(minutes=10)
+
+
+@dataclass
+class HandleState:
+    last_submission_id: int = 0
+    last_activity: float = 0.0
+    next_poll: float = 0.0
+
+
+@dataclass
+class ContestState:
+    last_submission_id: int = 0
+    pages: int = 1
+
+
+def contest_end(contest: db.VirtualContest):
+    return contest.date_started.replace(tzinfo=timezone.utc) + CONTEST_LENGTH
+
+
+def earliest_start(contests: List[db.VirtualContest]):
+    return min(int(contest.date_started.replace(tzinfo=timezone.utc).timestamp()) for contest in contests)
+
+
+def find_solves(submissions: List[codeforces.Submission], contest: db.VirtualContest):
+    date_started = contest.date_started.replace(tzinfo=timezone.utc)
+    unsolved = {problem.problem_info.key: problem for problem in contest.get_unsolved_problems()}
+    solves: List[Tuple[db.Problem, datetime]] = []
+    for submission in sorted(submissions, key=lambda submission: submission.submission_id):
+        problem = unsolved.get(submission.problem_key)
+        if problem is None or submission.verdict != 'OK':
+            continue
+        date_solved = datetime.fromtimestamp(submission.creation_time_seconds, timezone.utc)
+        if date_started <= date_solved < date_started + CONTEST_LENGTH:
+            solves.append((problem, date_solved))
+            del unsolved[submission.problem_key]
+    return solves
+
+
+class SolvedChecker:
+    def __init__(self, journal: EventJournal, shard: int = 0, shard_count: int = 1):
+        self.journal = journal
+        self.shard = shard
+        self.shard_count = shard_count
+        self.states: Dict[str, HandleState] = {}
+        self.contest_states: Dict[int, ContestState] = {}
+
+    def is_due(self, handle: str, contests: List[db.VirtualContest], now: datetime):
+        state = self.states.get(handle)
+        if state is None or state.next_poll <= now.timestamp():
+            return True
+        return any(contest_end(contest) <= now for contest in contests)
+
+    def schedule(self, handle: str, submissions: List[codeforces.Submission]):
+        state = self.states.setdefault(handle, HandleState())
+        now = time.time()
+        if submissions:
+            state.last_activity = max(state.last_activity, max(
+                submission.creation_time_seconds for submission in submissions))
+        hot = now - state.last_activity <= HOT_WINDOW
+        state.next_poll = now + (HOT_INTERVAL if hot else IDLE_INTERVAL)
+
+    async def poll(self, handle: str, contests: List[db.VirtualContest]):
+        state = self.states.setdefault(handle, HandleState())
+        submissions = await solved.fetch_new_submissions(
+            handle, state.last_submission_id, since=earliest_start(contests), priority=ratelimiter.BACKGROUND)
+        state.last_submission_id = solved.next_watermark(submissions, state.last_submission_id)
+        self.schedule(handle, submissions)
+        return submissions
+
+    async def poll_contest(self, contest_id: int, since: int):
+        state = self.contest_states.setdefault(contest_id, ContestState())
+        submissions, state.pages = await solved.fetch_new_contest_submissions(
+            contest_id, state.last_submission_id, since, priority=ratelimiter.BACKGROUND)
+        state.last_submission_id = solved.next_watermark(submissions, state.last_submission_id)
+        return submissions
+
+    async def poll_by_handle(self, due: List[Tuple[str, List[db.VirtualContest]]]):
+        return await asyncio.gather(*(self.poll(handle, contests) for handle, contests in due),
+                                    return_exceptions=True)
+
+    async def poll_by_contest(self, due: List[Tuple[str, List[db.VirtualContest]]],
+                              interested: Dict[int, Dict[str, List[db.VirtualContest]]]):
+        # One contest.status poll serves every handle with an unsolved problem from that contest,
+        # including handles that are not due yet, since the contest watermark moves past their submissions too.
+        contest_ids = sorted({contest_id for handle, _ in due for contest_id, handles in interested.items()
+                              if handle in handles})
+        results = await asyncio.gather(
+            *(self.poll_contest(contest_id, earliest_start(
+                [contest for contests in interested[contest_id].values() for contest in contests]))
+              for contest_id in contest_ids),
+            return_exceptions=True)
+
+        # Submissions from the polls that succeeded are kept even when another contest of the same
+        # handle failed, because their watermarks have already moved past them.
+        by_handle: Dict[str, List[codeforces.Submission]] = defaultdict(list)
+        failed = set()
+        for contest_id, submissions in zip(contest_ids, results):
+            if isinstance(submissions, Exception):
+                logging.warning('Failed to poll submissions of contest %d: %r', contest_id, submissions)
+                failed.update(interested[contest_id])
+                continue
+            for handle in interested[contest_id]:
+                by_handle[handle].extend(submission for submission in submissions
+                                         if handle.lower() in submission.handles)
+        for handle, submissions in by_handle.items():
+            if handle not in failed:
+                self.schedule(handle, submissions)
+        return by_handle, failed
+
+    def contest_poll_cost(self, due: List[Tuple[str, List[db.VirtualContest]]],
+                          interested: Dict[int, Dict[str, List[db.VirtualContest]]]):
+        contest_ids = {contest_id for handle, _ in due for contest_id, handles in interested.items()
+                       if handle in handles}
+        return sum(self.contest_states.get(contest_id, ContestState()).pages for contest_id in contest_ids)
+
+    async def tick(self):
+        now = datetime.now(timezone.utc)
+        contests_by_handle: Dict[str, List[db.VirtualContest]] = defaultdict(list)
+        # Holding the lock keeps a flush from committing and dropping events between the read and apply().
+        async with self.journal.lock:
+            active = self.journal.apply(await db.VirtualContest.get_active(self.shard, self.shard_count))
+        for contest in active:
+            contests_by_handle[contest.user.handle].append(contest)
+
+        interested: Dict[int, Dict[str, List[db.VirtualContest]]] = defaultdict(lambda: defaultdict(list))
+        for handle, contests in contests_by_handle.items():
+            for contest in contests:
+                for problem in contest.get_unsolved_problems():
+                    if problem.problem_info.contest_id is not None:
+                        interested[problem.problem_info.contest_id][handle].append(contest)
+
+        for handle in self.states.keys() - contests_by_handle.keys():
+            del self.states[handle]
+        for contest_id in self.contest_states.keys() - interested.keys():
+            del self.contest_states[contest_id]
+
+        due = [(handle, contests) for handle, contests in contests_by_handle.items()
+               if self.is_due(handle, contests, now)]
+        by_handle: Dict[str, List[codeforces.Submission]] = {}
+        failed = set()
+        if codeforces.breaker.is_open:
+            logging.warning('Codeforces API circuit is open, pausing solve checks')
+            metrics.increment('solved_checker.paused_ticks')
+        elif due and self.contest_poll_cost(due, interested) < len(due):
+            metrics.increment('solved_checker.contest_mode_ticks')
+            by_handle, failed = await self.poll_by_contest(due, interested)
+        else:
+            for (handle, _), submissions in zip(due, await self.poll_by_handle(due)):
+                if isinstance(submissions, Exception):
+                    logging.warning('Failed to poll submissions of %s: %r', handle, submissions)
+                    failed.add(handle)
+                else:
+                    by_handle[handle] = submissions
+
+        solves: List[Tuple[db.Problem, datetime]] = []
+        for handle, submissions in by_handle.items():
+            for contest in contests_by_handle[handle]:
+                solves.extend(find_solves(submissions, contest))
+        if solves:
+            await self.journal.record_solves(solves)
+
+        # Contests that end during an outage are only failed once polling has recovered.
+        finished: List[Tuple[db.VirtualContest, bool]] = []
+        for handle, contests in contests_by_handle.items():
+            for contest in contests:
+                if all(problem.date_solved is not None for problem in contest.problems):
+                    finished.append((contest, True))
+                elif contest_end(contest) <= now and not codeforces.breaker.tripped and \
+                        (handle not in failed or contest_end(contest) + FAILURE_GRACE <= now):
+                    finished.append((contest, False))
+        return finished
+
+    async def check(self, announcer: Announcer, holds_lease: Callable[[], bool] = lambda: True):
+        with metrics.timed('solved_checker_loop'):
+            finished = await self.tick()
+        if finished and not holds_lease():
+            logging.warning('Lost checker shard %d during a tick, leaving its results to the new owner', self.shard)
+            return
+        if finished:
+            await self.journal.record_finishes([contest for contest, _ in finished])
+            await announcer.announce_all(finished)
@@ -1,63 +1,237 @@
-import requests
-from dataclasses import dataclass
+import asyncio
+import codecs
+import json
+import logging
+import random
+import re
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Pattern, Tuple
+
+import aiohttp
+
+import metrics
+import ratelimiter
+from config import CODEFORCES_API_RATE, CODEFORCES_API_URL
 
 CODEFORCES_URL = 'https://codeforces.com'
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=30, connect=10)
+STREAM_CHUNK_SIZE = 64 * 1024
+RESULT_MARKER = re.compile(r'"result"\s*:\s*\[')
+PROBLEMS_MARKER = re.compile(r'"problems"\s*:\s*\[')
+
+MAX_ATTEMPTS = 3
+RETRY_BACKOFF = 1.0
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 60
+
+_decoder = json.JSONDecoder()
+
+_session: aiohttp.ClientSession | None = None
+limiter = ratelimiter.RateLimiter(CODEFORCES_API_RATE)
 
 
 class InvalidHandleException(Exception):
     pass
 
 
-@dataclass(init=False, unsafe_hash=True)
+class CodeforcesError(RuntimeError):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, threshold: int = BREAKER_THRESHOLD, cooldown: float = BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: float | None = None
+        self.probing = False
+
+    @property
+    def tripped(self):
+        return self.opened_at is not None
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None and time.monotonic() - self.opened_at < self.cooldown
+
+    def before_request(self):
+        if self.opened_at is None:
+            return
+        if self.is_open or self.probing:
+            raise CodeforcesError('Codeforces API is unavailable')
+        # Half open: let a single request through to probe whether the API is back.
+        self.probing = True
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logging.info('Codeforces API recovered, closing circuit')
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.failures >= self.threshold:
+            if self.opened_at is None:
+                logging.warning('Codeforces API failed %d times in a row, opening circuit', self.failures)
+                metrics.increment('codeforces.circuit_opened')
+            self.opened_at = time.monotonic()
+
+
+breaker = CircuitBreaker()
+
+
+@dataclass(init=False, unsafe_hash=True, slots=True)
 class Problem:
     contest_id: int | None
     index: str
     name: str
     rating: int | None
+    tags: Tuple[str, ...] = field(default=(), compare=False)
 
     def __init__(self, value):
         self.contest_id = value.get('contestId', None)
         self.index = value['index']
         self.name = value['name']
         self.rating = value.get('rating', None)
+        self.tags = tuple(map(sys.intern, value.get('tags', ())))
+
+    def to_json(self):
+        return {'contestId': self.contest_id, 'index': self.index, 'name': self.name,
+                'rating': self.rating, 'tags': list(self.tags)}
+
+    @property
+    def key(self):
+        return self.contest_id, self.index
 
     @property
     def url(self):
         return f'{CODEFORCES_URL}/contest/{self.contest_id}/problem/{self.index}'
 
 
-@dataclass(init=False)
+@dataclass(init=False, slots=True)
 class Submission:
-    problem: Problem
+    submission_id: int
+    contest_id: int | None
+    index: str
     verdict: str | None
     creation_time_seconds: int
+    handles: Tuple[str, ...]
 
     def __init__(self, value):
-        self.problem = Problem(value['problem'])
+        self.submission_id = value['id']
+        self.contest_id = value['problem'].get('contestId', None)
+        self.index = value['problem']['index']
         self.verdict = value.get('verdict', None)
         self.creation_time_seconds = value['creationTimeSeconds']
+        self.handles = tuple(sys.intern(member['handle'].lower())
+                             for member in value.get('author', {}).get('members', ()))
+
+    @property
+    def problem_key(self):
+        return self.contest_id, self.index
 
 
-def get_problemset(*args):
-    try:
-        resp = requests.get(f'{CODEFORCES_URL}/api/problemset.problems',
-                            params={'tags': ';'.join(args)})
-        resp.raise_for_status()
-    except (requests.exceptions.Timeout, requests.exceptions.RequestException) as exc:
-        raise RuntimeError('Failed to fetch problemset') from exc
-        
-    data = resp.json()
-    assert data['status'] == 'OK'
-    return list(map(Problem, data['result']['problems']))
-
-def get_submissions(handle: str, count=None):
+def get_session():
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            timeout=REQUEST_TIMEOUT, connector=aiohttp.TCPConnector(limit=10))
+    return _session
+
+
+async def close():
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+async def _read_list(content: aiohttp.StreamReader, marker: Pattern, parse: Callable):
+    # Decodes the elements of the list following marker one at a time, so the whole payload
+    # never exists as a string or as dicts at once. Bodies without the marker are errors.
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer, pos, items = '', 0, None
+    async for chunk in content.iter_chunked(STREAM_CHUNK_SIZE):
+        buffer = buffer[pos:] + decoder.decode(chunk)
+        pos = 0
+        if items is None:
+            match = marker.search(buffer)
+            if match is None:
+                continue
+            items, pos = [], match.end()
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if buffer.startswith(']', pos):
+                return {'status': 'OK'}, items
+            try:
+                value, pos = _decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                break
+            items.append(parse(value))
+    if items is not None:
+        raise ValueError('Truncated response')
+    return json.loads(buffer + decoder.decode(b'', final=True)), None
+
+
+async def _fetch(method: str, params: dict, priority: int, marker: Pattern, parse: Callable):
+    for attempt in range(MAX_ATTEMPTS):
+        with metrics.timed('codeforces.rate_limit_wait'):
+            await limiter.acquire(priority)
+        try:
+            with metrics.timed(f'codeforces.{method}'):
+                async with get_session().get(f'{CODEFORCES_API_URL}/{method}', params=params) as resp:
+                    if resp.status not in (200, 400):
+                        resp.raise_for_status()
+                    return await _read_list(resp.content, marker, parse)
+        except (aiohttp.ClientError, TimeoutError, ValueError) as exc:
+            metrics.increment(f'codeforces.{method}.errors')
+            if attempt + 1 == MAX_ATTEMPTS:
+                raise CodeforcesError(f'Failed to fetch {method}') from exc
+        metrics.increment(f'codeforces.{method}.retries')
+        await asyncio.sleep(RETRY_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5))
+
+
+async def _request(method: str, params: dict, priority: int, marker: Pattern, parse: Callable):
+    breaker.before_request()
+    params = {key: str(value) for key, value in params.items() if value is not None}
     try:
-        resp = requests.get(f'{CODEFORCES_URL}/api/user.status',
-                        params={'handle': handle, 'count': count})
-        resp.raise_for_status()
-    except (requests.exceptions.Timeout, requests.exceptions.RequestException) as exc:
-        raise RuntimeError('Failed to fetch submissions') from exc
-    data = resp.json()
+        result = await _fetch(method, params, priority, marker, parse)
+    except CodeforcesError:
+        breaker.record_failure()
+        raise
+    except BaseException:
+        breaker.probing = False
+        raise
+    breaker.record_success()
+    return result
+
+
+async def get_problemset(*args, priority=ratelimiter.INTERACTIVE):
+    data, problems = await _request('problemset.problems', {'tags': ';'.join(args)}, priority,
+                                    PROBLEMS_MARKER, Problem)
+    if data['status'] != 'OK':
+        raise CodeforcesError('Failed to fetch problemset')
+    return problems
+
+
+async def get_submissions(handle: str, count=None, start=None, priority=ratelimiter.BACKGROUND):
+    data, submissions = await _request('user.status', {'handle': handle, 'from': start, 'count': count}, priority,
+                                       RESULT_MARKER, Submission)
+    if data['status'] != 'OK':
+        if data.get('comment', '').startswith('handle:'):
+            raise InvalidHandleException()
+        raise CodeforcesError(f"Failed to fetch submissions: {data.get('comment')}")
+    return submissions
+
+
+async def get_contest_submissions(contest_id: int, count=None, start=None, priority=ratelimiter.BACKGROUND):
+    data, submissions = await _request('contest.status', {'contestId': contest_id, 'from': start, 'count': count},
+                                       priority, RESULT_MARKER, Submission)
     if data['status'] != 'OK':
-        raise InvalidHandleException()
-    return list(map(Submission, data['result']))
+        raise CodeforcesError(f"Failed to fetch contest submissions: {data.get('comment')}")
+    return submissions
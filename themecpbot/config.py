@@ -5,10 +5,16 @@ load_dotenv()
 
 COMMAND_PREFIX = ';themecp '
 TOKEN = os.environ.get('TOKEN')
+CODEFORCES_API_URL = os.environ.get('CODEFORCES_API_URL', 'https://codeforces.com/api')
+CODEFORCES_API_RATE = float(os.environ.get('CODEFORCES_API_RATE', 0.5))
+CHECKER_SHARDS = int(os.environ.get('CHECKER_SHARDS', 0))
 DATA_FOLDER = Path(__file__).parent.absolute().joinpath('data')
 DATABASE_URL = os.environ.get('DATABASE_URL')
 if DATABASE_URL is None:
-    DATABASE_URL = f'sqlite:///{DATA_FOLDER}/themecpbot.db'
+    DATABASE_URL = f'sqlite+aiosqlite:///{DATA_FOLDER}/themecpbot.db'
 
-if DATABASE_URL.startswith('postgres://'):
-    DATABASE_URL = DATABASE_URL.replace('postgres://', 'postgresql://', 1)
+for scheme, async_scheme in (('postgres://', 'postgresql+asyncpg://'),
+                             ('postgresql://', 'postgresql+asyncpg://'),
+                             ('sqlite://', 'sqlite+aiosqlite://')):
+    if DATABASE_URL.startswith(scheme):
+        DATABASE_URL = DATABASE_URL.replace(scheme, async_scheme, 1)
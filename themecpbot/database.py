@@ -1,20 +1,140 @@
-from datetime import datetime, timezone
-from typing import List, Optional
+import hashlib
+import math
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import (String, ForeignKey, BigInteger, DateTime, Index, JSON, TypeDecorator,
+                        case, delete, event, func, insert, inspect, select, text, update, and_, or_)
+from sqlalchemy.exc import DBAPIError, IntegrityError
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import relationship, selectinload, Mapped, mapped_column, DeclarativeBase
+
+import codeforces
+import metrics
+from config import DATABASE_URL
 
-from sqlalchemy import create_engine, String, ForeignKey, BigInteger
-from sqlalchemy.orm import sessionmaker, relationship, Mapped, mapped_column, DeclarativeBase
 
-from config import DATABASE_URL
+engine = create_async_engine(DATABASE_URL)
+
+Session = async_sessionmaker(engine, expire_on_commit=False)
+
+
+@asynccontextmanager
+async def transaction(name: str):
+    with metrics.timed(f'database.commit.{name}'):
+        async with Session.begin() as session:
+            yield session
+
+
+def count_statement(*args):
+    metrics.increment('database.statements')
+
+
+event.listen(engine.sync_engine, 'before_cursor_execute', count_statement)
+
+
+def schema_fingerprint():
+    parts = []
+    for table in Base.metadata.sorted_tables:
+        parts.append(table.name)
+        parts.extend(f'{column.name}:{column.type}:{column.nullable}' for column in table.columns)
+        parts.extend(sorted(index.name for index in table.indexes))
+    return hashlib.sha1('\n'.join(parts).encode()).hexdigest()
+
+
+async def init():
+    fingerprint = schema_fingerprint()
+    try:
+        async with engine.connect() as conn:
+            if await conn.scalar(select(SchemaInfo.fingerprint)) == fingerprint:
+                return
+    except DBAPIError:
+        pass
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(migrate)
+        await conn.execute(delete(SchemaInfo))
+        await conn.execute(insert(SchemaInfo).values(fingerprint=fingerprint))
+
+
+def migrate(conn):
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in columns and column.nullable:
+                conn.execute(text(
+                    f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(conn.dialect)}'))
+
+    existing = {index['name']: bool(index['unique']) for table in Base.metadata.tables
+                for index in inspector.get_indexes(table)}
+
+    if existing.get('ix_virtual_contests_active') is not True:
+        # Keep only the newest unfinished contest per user before the index becomes unique.
+        duplicates = select(VirtualContest.virtual_contest_id).where(
+            (VirtualContest.finished == False) & VirtualContest.virtual_contest_id.not_in(
+                select(func.max(VirtualContest.virtual_contest_id))
+                .where(VirtualContest.finished == False)
+                .group_by(VirtualContest.user_id)))
+        duplicates = conn.execute(duplicates).all()
+        if duplicates:
+            conn.execute(update(VirtualContest)
+                         .where(VirtualContest.virtual_contest_id.in_([row[0] for row in duplicates]))
+                         .values(finished=True))
+
+    if 'ix_problem_infos_key' not in existing:
+        conn.execute(text(
+            'UPDATE problems SET problem_info_id = ('
+            'SELECT MIN(b.problem_info_id) FROM problem_infos a JOIN problem_infos b '
+            'ON a.contest_id = b.contest_id AND a."index" = b."index" '
+            'WHERE a.problem_info_id = problems.problem_info_id)'))
+        conn.execute(text(
+            'DELETE FROM problem_infos WHERE problem_info_id NOT IN ('
+            'SELECT MIN(problem_info_id) FROM problem_infos GROUP BY contest_id, "index")'))
 
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name in existing and existing[index.name] != bool(index.unique):
+                index.drop(conn)
+                del existing[index.name]
+            if index.name not in existing:
+                index.create(conn)
 
-engine = create_engine(DATABASE_URL)
 
-Session = sessionmaker(bind=engine)
-session = Session()
+def dialect():
+    return postgresql if engine.dialect.name == 'postgresql' else sqlite
+
+
+def insert_ignore(model):
+    return dialect().insert(model).on_conflict_do_nothing()
+
+
+class UTCDateTime(TypeDecorator):
+    impl = DateTime
+    cache_ok = True
+
+    def process_bind_param(self, value: datetime | None, dialect):
+        if value is not None and value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value
+
+    def process_result_value(self, value: datetime | None, dialect):
+        if value is not None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value
 
 
 class Base(DeclarativeBase):
-    pass
+    type_annotation_map = {datetime: UTCDateTime}
+
+
+class SchemaInfo(Base):
+    __tablename__ = 'schema_info'
+
+    fingerprint: Mapped[str] = mapped_column(String(40), primary_key=True)
 
 
 class User(Base):
@@ -23,46 +143,87 @@ class User(Base):
     user_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
     handle: Mapped[str] = mapped_column(String(24))
     contests: Mapped[List['VirtualContest']
-                     ] = relationship(back_populates='user')
+                     ] = relationship(back_populates='user', lazy='raise')
 
     @staticmethod
-    def create(user_id: int, handle: str):
-        session.add(User(user_id=user_id, handle=handle))
-        session.commit()
+    async def create(user_id: int, handle: str):
+        async with transaction('User.create') as session:
+            session.add(User(user_id=user_id, handle=handle))
 
     @staticmethod
-    def find(user_id: int):
-        return session.get(User, user_id)
-
-    def create_contest(self, tag: str, channel_id: int, level: int):
-        contest = VirtualContest(user=self, tag=tag, channel_id=channel_id, level=level)
-        session.add(contest)
-        session.commit()
-        return contest
+    async def find(user_id: int):
+        async with Session() as session:
+            return await session.get(User, user_id)
 
-    @property
-    def current_contest(self):
-        contest = next((c for c in self.contests if not c.finished), None)
-        return contest
+    @staticmethod
+    async def find_many(user_ids: List[int]):
+        async with Session() as session:
+            result = await session.scalars(select(User).where(User.user_id.in_(user_ids)))
+            return {user.user_id: user for user in result}
 
 
 class ProblemInfo(Base):
     __tablename__ = 'problem_infos'
+    __table_args__ = (Index('ix_problem_infos_key', 'contest_id', 'index', unique=True),)
+
     problem_info_id: Mapped[int] = mapped_column(primary_key=True)
     contest_id: Mapped[int]
     index: Mapped[str] = mapped_column(String(3))
     name: Mapped[str]
     rating: Mapped[int]
 
+    @property
+    def key(self):
+        return self.contest_id, self.index
+
+
+class SolvedCache(Base):
+    __tablename__ = 'solved_caches'
+
+    handle: Mapped[str] = mapped_column(String(24), primary_key=True)
+    last_submission_id: Mapped[int] = mapped_column(BigInteger, default=0)
+    problems: Mapped[List['SolvedProblem']] = relationship()
+
+    @staticmethod
+    async def get(handle: str):
+        async with Session() as session:
+            cache = await session.get(SolvedCache, handle)
+            if cache is None:
+                return 0, set()
+            problems = await session.execute(
+                select(SolvedProblem.contest_id, SolvedProblem.index).where(SolvedProblem.handle == handle))
+            return cache.last_submission_id, set(map(tuple, problems))
+
     @staticmethod
-    def create(contest_id: int, index: str, name: str, rating: int):
-        problem_info = session.query(ProblemInfo).where(
-            (ProblemInfo.contest_id == contest_id) & (ProblemInfo.index == index)).first()
-        if problem_info is None:
-            problem_info = ProblemInfo(contest_id=contest_id, index=index, name=name, rating=rating)
-            session.add(problem_info)
-            session.commit()
-        return problem_info
+    async def update(handle: str, last_submission_id: int, solved: Set[Tuple[int, str]]):
+        # Concurrent lookups of the same handle race to write the same rows, so both writes tolerate conflicts.
+        async with transaction('SolvedCache.update') as session:
+            upsert = dialect().insert(SolvedCache).values(handle=handle, last_submission_id=last_submission_id)
+            await session.execute(upsert.on_conflict_do_update(
+                index_elements=[SolvedCache.handle],
+                set_={'last_submission_id': case(
+                    (SolvedCache.last_submission_id < upsert.excluded.last_submission_id,
+                     upsert.excluded.last_submission_id),
+                    else_=SolvedCache.last_submission_id)}))
+            if solved:
+                await session.execute(insert_ignore(SolvedProblem), [
+                    {'handle': handle, 'contest_id': contest_id, 'index': index} for contest_id, index in solved
+                ])
+
+
+class SolvedProblem(Base):
+    __tablename__ = 'solved_problems'
+
+    handle: Mapped[str] = mapped_column(ForeignKey('solved_caches.handle'), primary_key=True)
+    contest_id: Mapped[int] = mapped_column(primary_key=True)
+    index: Mapped[str] = mapped_column(String(3), primary_key=True)
+
+
+def get_penalty(date_started: datetime, date_solved: Optional[datetime]):
+    if date_solved is None:
+        return -1
+    return int((date_solved.replace(tzinfo=timezone.utc) -
+                date_started.replace(tzinfo=timezone.utc)).total_seconds() / 60)
 
 
 class VirtualContest(Base):
@@ -76,27 +237,38 @@ class VirtualContest(Base):
     level: Mapped[int]
     user_id: Mapped[int] = mapped_column(BigInteger, ForeignKey('users.user_id'))
     channel_id: Mapped[int] = mapped_column(BigInteger)
+    guild_id: Mapped[Optional[int]] = mapped_column(BigInteger, index=True)
     problems: Mapped[List['Problem']] = relationship(
         order_by='Problem.problem_id')
     user: Mapped[User] = relationship(back_populates='contests')
 
-    def add_problem(self, contest_id: int, index: str, title: str, rating: int):
-        problem_info = ProblemInfo.create(contest_id, index, title, rating)
-        problem = Problem(problem_info=problem_info,
-                          virtual_contest_id=self.virtual_contest_id)
-        session.add(problem)
-        session.commit()
-
     def get_unsolved_problems(self):
         return [problem for problem in self.problems if problem.date_solved is None]
 
+    def get_penalties(self):
+        return [get_penalty(self.date_started, problem.date_solved) for problem in self.problems]
+
     @staticmethod
-    def get_active():
-        return session.query(VirtualContest).where(VirtualContest.finished == False).all()
+    def with_problems():
+        return selectinload(VirtualContest.problems).selectinload(Problem.problem_info)
 
-    def finish(self):
-        self.finished = True
-        session.commit()
+    @staticmethod
+    async def get_current(user_id: int):
+        async with Session() as session:
+            return await session.scalar(
+                select(VirtualContest)
+                .where((VirtualContest.user_id == user_id) & (VirtualContest.finished == False))
+                .options(VirtualContest.with_problems()))
+
+    @staticmethod
+    async def get_active(shard: int = 0, shard_count: int = 1):
+        query = select(VirtualContest).where(VirtualContest.finished == False)
+        if shard_count > 1:
+            query = query.where(VirtualContest.user_id % shard_count == shard)
+        async with Session() as session:
+            result = await session.scalars(
+                query.options(VirtualContest.with_problems(), selectinload(VirtualContest.user)))
+            return result.all()
 
 
 class Problem(Base):
@@ -109,13 +281,260 @@ class Problem(Base):
     problem_info_id: Mapped[int] = mapped_column(
         ForeignKey('problem_infos.problem_info_id'))
     virtual_contest_id: Mapped[int] = mapped_column(
-        ForeignKey('virtual_contests.virtual_contest_id'))
+        ForeignKey('virtual_contests.virtual_contest_id'), index=True)
 
     problem_info: Mapped[ProblemInfo] = relationship()
 
-    def set_date_solved(self, date_solved):
-        self.date_solved = date_solved
-        session.commit()
+
+class ContestResult(Base):
+    __tablename__ = 'contest_results'
+
+    virtual_contest_id: Mapped[int] = mapped_column(
+        ForeignKey('virtual_contests.virtual_contest_id'), primary_key=True)
+    user_id: Mapped[int] = mapped_column(BigInteger, index=True)
+    date_started: Mapped[datetime]
+    tag: Mapped[str]
+    level: Mapped[int]
+    penalties: Mapped[List[int]] = mapped_column(JSON)
+    solved: Mapped[int]
+    performance: Mapped[int]
+
+    @staticmethod
+    async def find_recent(user_id: int, limit: int):
+        async with Session() as session:
+            result = await session.scalars(
+                select(ContestResult)
+                .where(ContestResult.user_id == user_id)
+                .order_by(ContestResult.virtual_contest_id.desc())
+                .limit(limit))
+            return result.all()
+
+    @staticmethod
+    async def add_many(results: List[dict]):
+        if not results:
+            return
+        async with transaction('ContestResult.add_many') as session:
+            await record_results(session, results)
+
+
+class UserStats(Base):
+    __tablename__ = 'user_stats'
+
+    user_id: Mapped[int] = mapped_column(BigInteger, ForeignKey('users.user_id'), primary_key=True)
+    contests: Mapped[int]
+    total_performance: Mapped[int] = mapped_column(BigInteger)
+    best_performance: Mapped[int]
+
+    @property
+    def average_performance(self):
+        return round(self.total_performance / self.contests) if self.contests else 0
+
+    @staticmethod
+    async def find_many(user_ids: List[int]):
+        async with Session() as session:
+            result = await session.scalars(select(UserStats).where(UserStats.user_id.in_(user_ids)))
+            return {stats.user_id: stats for stats in result}
+
+    @staticmethod
+    async def rebuild(user_ids: List[int]):
+        async with transaction('UserStats.rebuild') as session:
+            await insert_missing_stats(session, user_ids)
+
+
+async def insert_missing_stats(session, user_ids):
+    # Rows that already exist are left alone, so a concurrently inserted row keeps its increments.
+    result = await session.scalars(
+        dialect().insert(UserStats).from_select(
+            ['user_id', 'contests', 'total_performance', 'best_performance'],
+            select(ContestResult.user_id, func.count(), func.sum(ContestResult.performance),
+                   func.max(ContestResult.performance))
+            .where(ContestResult.user_id.in_(user_ids))
+            .group_by(ContestResult.user_id))
+        .on_conflict_do_nothing()
+        .returning(UserStats.user_id))
+    return set(result)
+
+
+async def record_results(session, results: List[dict]):
+    inserted = (await session.execute(
+        insert_ignore(ContestResult).returning(ContestResult.user_id, ContestResult.performance),
+        results)).all()
+    performances: Dict[int, List[int]] = {}
+    for user_id, performance in inserted:
+        performances.setdefault(user_id, []).append(performance)
+
+    # New rows are aggregated from contest_results and already count this batch.
+    created = await insert_missing_stats(session, list(performances))
+    for user_id, user_performances in performances.items():
+        if user_id in created:
+            continue
+        best = max(user_performances)
+        await session.execute(
+            update(UserStats)
+            .where(UserStats.user_id == user_id)
+            .values(contests=UserStats.contests + len(user_performances),
+                    total_performance=UserStats.total_performance + sum(user_performances),
+                    best_performance=case((UserStats.best_performance < best, best),
+                                          else_=UserStats.best_performance)))
+
+
+class CheckerWorker(Base):
+    __tablename__ = 'checker_workers'
+
+    owner: Mapped[str] = mapped_column(String(64), primary_key=True)
+    expires_at: Mapped[datetime]
+
+
+class CheckerLease(Base):
+    __tablename__ = 'checker_leases'
+
+    shard: Mapped[int] = mapped_column(primary_key=True, autoincrement=False)
+    owner: Mapped[Optional[str]] = mapped_column(String(64))
+    expires_at: Mapped[datetime]
+
+    @staticmethod
+    async def acquire(owner: str, shard_count: int, duration: timedelta):
+        # Each live worker holds at most its fair share, so idle workers can pick up the excess.
+        now = datetime.now(timezone.utc)
+        async with transaction('CheckerLease.acquire') as session:
+            await session.execute(delete(CheckerWorker).where(CheckerWorker.expires_at <= now))
+            heartbeat = dialect().insert(CheckerWorker).values(owner=owner, expires_at=now + duration)
+            await session.execute(heartbeat.on_conflict_do_update(
+                index_elements=[CheckerWorker.owner], set_={'expires_at': heartbeat.excluded.expires_at}))
+            workers = await session.scalar(select(func.count()).select_from(CheckerWorker))
+            share = math.ceil(shard_count / workers)
+
+            await session.execute(insert_ignore(CheckerLease), [
+                {'shard': shard, 'owner': None, 'expires_at': now} for shard in range(shard_count)
+            ])
+            owned = (await session.scalars(
+                select(CheckerLease.shard)
+                .where((CheckerLease.shard < shard_count) & (CheckerLease.owner == owner))
+                .order_by(CheckerLease.shard))).all()
+            if len(owned) > share:
+                await session.execute(
+                    update(CheckerLease)
+                    .where(CheckerLease.shard.in_(owned[share:]) & (CheckerLease.owner == owner))
+                    .values(owner=None, expires_at=now))
+            free = (await session.scalars(
+                select(CheckerLease.shard)
+                .where((CheckerLease.shard < shard_count) & (CheckerLease.expires_at <= now) &
+                       CheckerLease.shard.not_in(owned))
+                .order_by(CheckerLease.shard)
+                .limit(max(0, share - len(owned))))).all()
+            # Shards taken by another worker since they were selected fail the owner and expiry checks.
+            await session.execute(
+                update(CheckerLease)
+                .where((CheckerLease.shard.in_(owned[:share]) & (CheckerLease.owner == owner)) |
+                       (CheckerLease.shard.in_(free) & (CheckerLease.expires_at <= now)))
+                .values(owner=owner, expires_at=now + duration))
+            result = await session.scalars(
+                select(CheckerLease.shard)
+                .where((CheckerLease.shard < shard_count) & (CheckerLease.owner == owner)))
+            return set(result)
+
+    @staticmethod
+    async def release(owner: str):
+        now = datetime.now(timezone.utc)
+        async with transaction('CheckerLease.release') as session:
+            await session.execute(delete(CheckerWorker).where(CheckerWorker.owner == owner))
+            await session.execute(
+                update(CheckerLease)
+                .where(CheckerLease.owner == owner)
+                .values(owner=None, expires_at=now))
+
+
+Index('ix_virtual_contests_active', VirtualContest.user_id, unique=True,
+      postgresql_where=VirtualContest.finished == False,
+      sqlite_where=VirtualContest.finished == False)
+
+
+async def apply_events(solves: Dict[int, datetime], finishes: Dict[int, dict]):
+    async with transaction('apply_events') as session:
+        if solves:
+            await session.execute(update(Problem), [
+                {'problem_id': problem_id, 'date_solved': date_solved}
+                for problem_id, date_solved in solves.items()
+            ])
+        if not finishes:
+            return
+
+        unfinished = {row.virtual_contest_id: row for row in await session.execute(
+            select(VirtualContest.virtual_contest_id, VirtualContest.user_id, VirtualContest.date_started,
+                   VirtualContest.tag, VirtualContest.level)
+            .where(VirtualContest.virtual_contest_id.in_(finishes) & (VirtualContest.finished == False)))}
+        if not unfinished:
+            return
+        await session.execute(
+            update(VirtualContest)
+            .where(VirtualContest.virtual_contest_id.in_(unfinished))
+            .values(finished=True))
+
+        results = [
+            {'virtual_contest_id': virtual_contest_id, 'user_id': contest.user_id,
+             'date_started': contest.date_started, 'tag': contest.tag, 'level': contest.level,
+             'penalties': finishes[virtual_contest_id]['penalties'],
+             'solved': sum(penalty != -1 for penalty in finishes[virtual_contest_id]['penalties']),
+             'performance': finishes[virtual_contest_id]['performance']}
+            for virtual_contest_id, contest in sorted(unfinished.items())
+        ]
+        await record_results(session, results)
+
+
+async def get_unsummarized_contest_rows():
+    async with Session() as session:
+        result = await session.execute(
+            select(VirtualContest.virtual_contest_id, VirtualContest.user_id, VirtualContest.level,
+                   VirtualContest.tag, VirtualContest.date_started, ProblemInfo.rating, Problem.date_solved)
+            .join(Problem, Problem.virtual_contest_id == VirtualContest.virtual_contest_id)
+            .join(ProblemInfo, ProblemInfo.problem_info_id == Problem.problem_info_id)
+            .outerjoin(ContestResult, ContestResult.virtual_contest_id == VirtualContest.virtual_contest_id)
+            .where((VirtualContest.finished == True) & (ContestResult.virtual_contest_id == None))
+            .order_by(VirtualContest.virtual_contest_id, Problem.problem_id))
+        return result.all()
+
+
+async def get_guild_user_ids(guild_id: int, channel_ids: List[int]):
+    # Contests started before guild_id existed are matched by the channel they were started in.
+    async with Session() as session:
+        result = await session.scalars(
+            select(VirtualContest.user_id).where(
+                (VirtualContest.guild_id == guild_id) |
+                ((VirtualContest.guild_id == None) & VirtualContest.channel_id.in_(channel_ids))).distinct())
+        return result.all()
+
+
+class ActiveContestExistsException(Exception):
+    pass
 
 
-Base.metadata.create_all(engine)
+def violates_active_contest_index(exc: IntegrityError):
+    # Postgres names the index; SQLite only reports the indexed column.
+    message = str(exc.orig)
+    return 'ix_virtual_contests_active' in message or 'virtual_contests.user_id' in message
+
+
+async def create_contest_with_problems(user_id: int, tag: str, channel_id: int, level: int,
+                                       problems: List[codeforces.Problem], guild_id: Optional[int] = None):
+    try:
+        async with transaction('create_contest_with_problems') as session:
+            await session.execute(insert_ignore(ProblemInfo), [
+                {'contest_id': problem.contest_id, 'index': problem.index, 'name': problem.name,
+                 'rating': problem.rating}
+                for problem in problems
+            ])
+            existing = await session.scalars(select(ProblemInfo).where(or_(*(
+                and_(ProblemInfo.contest_id == problem.contest_id, ProblemInfo.index == problem.index)
+                for problem in problems))))
+            problem_infos = {problem_info.key: problem_info for problem_info in existing}
+
+            contest = VirtualContest(user_id=user_id, tag=tag, channel_id=channel_id, guild_id=guild_id,
+                                     level=level, finished=False,
+                                     problems=[Problem(problem_info=problem_infos[problem.key], date_solved=None)
+                                               for problem in problems])
+            session.add(contest)
+    except IntegrityError as exc:
+        if not violates_active_contest_index(exc):
+            raise
+        raise ActiveContestExistsException() from exc
+    return contest
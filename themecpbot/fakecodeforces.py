@@ -0,0 +1,115 @@
+import asyncio
+import random
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List
+
+from aiohttp import web
+
+import themecp
+
+RATINGS = range(800, 3600, 100)
+
+
+class FakeCodeforces:
+    def __init__(self, problem_count: int = 9000, history_size: int = 1000, latency: float = 0.05,
+                 rate: float = 0.5, burst: int = 5, error_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate = rate
+        self.burst = burst
+        self.random = random.Random(seed)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.calls: Counter = Counter()
+        self.throttled = 0
+        self.history_size = history_size
+        self.next_submission_id = 10 ** 9
+        self.problems = [self.make_problem(number) for number in range(problem_count)]
+        self.histories: Dict[str, List[dict]] = defaultdict(list)
+        self.contest_submissions: Dict[int, List[dict]] = defaultdict(list)
+        self.runner: web.AppRunner | None = None
+
+    def make_problem(self, number: int):
+        tags = self.random.sample(sorted(set(themecp.TAGS)), 2)
+        return {'contestId': 1 + number // 6, 'index': 'ABCDEF'[number % 6], 'name': f'Problem {number}',
+                'type': 'PROGRAMMING', 'rating': self.random.choice(RATINGS), 'tags': tags}
+
+    def make_submission(self, handle: str, problem: dict, verdict: str, creation_time: int):
+        self.next_submission_id += 1
+        return {'id': self.next_submission_id, 'contestId': problem['contestId'],
+                'creationTimeSeconds': creation_time, 'problem': problem, 'verdict': verdict,
+                'author': {'members': [{'handle': handle}]}, 'programmingLanguage': 'C++17', 'testset': 'TESTS'}
+
+    def history(self, handle: str):
+        history = self.histories[handle]
+        if not history and self.history_size:
+            start = int(time.time()) - 365 * 24 * 60 * 60
+            for offset in range(self.history_size):
+                problem = self.random.choice(self.problems)
+                verdict = self.random.choice(('OK', 'WRONG_ANSWER', 'TIME_LIMIT_EXCEEDED'))
+                history.append(self.make_submission(handle, problem, verdict, start + offset * 60))
+            history.reverse()
+        return history
+
+    def submit(self, handle: str, problem: dict, verdict: str = 'OK', creation_time: int = None):
+        submission = self.make_submission(handle, problem, verdict, creation_time or int(time.time()))
+        self.history(handle).insert(0, submission)
+        # Generated history is backdated but gets fresh ids, so it stays out of contest.status.
+        self.contest_submissions[problem['contestId']].append(submission)
+        return submission
+
+    def throttle(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            self.throttled += 1
+            return True
+        self.tokens -= 1
+        return False
+
+    async def handle(self, request: web.Request):
+        method = request.match_info['method']
+        self.calls[method] += 1
+        await asyncio.sleep(self.latency)
+        if self.throttle():
+            return web.json_response({'status': 'FAILED', 'comment': 'Call limit exceeded'}, status=503)
+        if self.random.random() < self.error_rate:
+            return web.Response(text='Bad Gateway', status=502)
+
+        if method == 'problemset.problems':
+            tags = set(filter(None, request.query.get('tags', '').split(';')))
+            problems = [problem for problem in self.problems if tags <= set(problem['tags'])]
+            return web.json_response({'status': 'OK', 'result': {'problems': problems, 'problemStatistics': []}})
+
+        if method == 'user.status':
+            handle = request.query['handle']
+            if handle.startswith('invalid'):
+                return web.json_response(
+                    {'status': 'FAILED', 'comment': f'handle: User with handle {handle} not found'}, status=400)
+            start = int(request.query.get('from', 1)) - 1
+            count = int(request.query.get('count', 10 ** 9))
+            return web.json_response({'status': 'OK', 'result': self.history(handle)[start:start + count]})
+
+        if method == 'contest.status':
+            submissions = sorted(self.contest_submissions[int(request.query['contestId'])],
+                                 key=lambda submission: submission['id'], reverse=True)
+            start = int(request.query.get('from', 1)) - 1
+            count = int(request.query.get('count', 10 ** 9))
+            return web.json_response({'status': 'OK', 'result': submissions[start:start + count]})
+
+        return web.json_response({'status': 'FAILED', 'comment': f'Unknown method {method}'}, status=400)
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0):
+        app = web.Application()
+        app.router.add_get('/api/{method}', self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = self.runner.addresses[0][1]
+        return f'http://{host}:{port}/api'
+
+    async def stop(self):
+        await self.runner.cleanup()
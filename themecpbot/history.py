@@ -0,0 +1,113 @@
+from itertools import groupby
+from operator import itemgetter
+from typing import List
+
+import discord
+from discord.ext import commands
+from table2ascii import table2ascii, Alignment
+
+import database as db
+import themecp
+from config import COMMAND_PREFIX
+from identifier import identified_required
+
+HISTORY_SIZE = 10
+LEADERBOARD_SIZE = 10
+
+
+def summarize(rows):
+    contests = [list(group) for _, group in groupby(rows, key=itemgetter(0))]
+    contests = [contest for contest in contests if len(contest) == 4]
+    if not contests:
+        return []
+    penalties = [[db.get_penalty(row.date_started, row.date_solved) for row in contest] for contest in contests]
+    performances = themecp.compute_performances(
+        [contest[0].level for contest in contests],
+        [[row.rating for row in contest] for contest in contests], penalties)
+    return [
+        {'virtual_contest_id': contest[0].virtual_contest_id, 'user_id': contest[0].user_id,
+         'date_started': contest[0].date_started, 'tag': contest[0].tag, 'level': contest[0].level,
+         'penalties': contest_penalties, 'solved': sum(penalty != -1 for penalty in contest_penalties),
+         'performance': performance}
+        for contest, contest_penalties, performance in zip(contests, penalties, performances.tolist())
+    ]
+
+
+async def get_stats(user_ids: List[int]):
+    stats = await db.UserStats.find_many(user_ids)
+    missing = [user_id for user_id in user_ids if user_id not in stats]
+    if missing:
+        await db.UserStats.rebuild(missing)
+        stats.update(await db.UserStats.find_many(missing))
+    return stats
+
+
+class History(commands.Cog):
+    async def cog_load(self):
+        # Contests finished before contest_results existed are summarized once, in bulk.
+        await db.ContestResult.add_many(summarize(await db.get_unsummarized_contest_rows()))
+
+    @commands.command(name='history')
+    @identified_required()
+    async def history(self, ctx: commands.Context):
+        user = await db.User.find(ctx.author.id)
+        user_stats = (await get_stats([user.user_id])).get(user.user_id)
+        if user_stats is None:
+            embed = discord.Embed(description='You have not finished any ThemeCP yet.', color=discord.Color.orange())
+            return await ctx.send(embed=embed)
+
+        results = await db.ContestResult.find_recent(user.user_id, HISTORY_SIZE)
+        table = table2ascii(
+            header=['Date', 'Level', 'Tag', 'Solved', 'Performance'],
+            body=[
+                [result.date_started.strftime('%Y-%m-%d'), result.level, result.tag, result.solved,
+                    result.performance]
+                for result in results
+            ],
+            alignments=[Alignment.LEFT] * 5
+        )
+        await ctx.send(f'```{user.handle}: {user_stats.contests} contests, '
+                       f'average {user_stats.average_performance}, best {user_stats.best_performance}\n{table}```')
+
+    @commands.command(name='leaderboard')
+    @commands.guild_only()
+    async def leaderboard(self, ctx: commands.Context):
+        channel_ids = [channel.id for channel in ctx.guild.channels] + [thread.id for thread in ctx.guild.threads]
+        user_ids = await db.get_guild_user_ids(ctx.guild.id, channel_ids)
+        stats = list((await get_stats(user_ids)).values())
+        if not stats:
+            embed = discord.Embed(description='No ThemeCP has been finished in this server yet.',
+                                  color=discord.Color.orange())
+            return await ctx.send(embed=embed)
+
+        stats.sort(key=lambda user_stats: user_stats.average_performance, reverse=True)
+        stats = stats[:LEADERBOARD_SIZE]
+        users = await db.User.find_many([user_stats.user_id for user_stats in stats])
+        table = table2ascii(
+            header=['#', 'Handle', 'Contests', 'Average', 'Best'],
+            body=[
+                [num, users[user_stats.user_id].handle, user_stats.contests,
+                    user_stats.average_performance, user_stats.best_performance]
+                for num, user_stats in enumerate(stats, 1)
+            ],
+            alignments=[Alignment.LEFT] * 5
+        )
+        await ctx.send(f'```{table}```')
+
+    @history.error
+    async def history_error(self, ctx: commands.Context, error: commands.CommandError):
+        if isinstance(error, commands.CheckFailure):
+            embed = discord.Embed(
+                description=f'You are not identified yet. Please identify first using the `{COMMAND_PREFIX}identify` command', color=discord.Color.orange())
+            await ctx.send(embed=embed)
+
+    @leaderboard.error
+    async def leaderboard_error(self, ctx: commands.Context, error: commands.CommandError):
+        if isinstance(error, commands.NoPrivateMessage):
+            embed = discord.Embed(
+                description='The leaderboard is only available in a server', color=discord.Color.orange())
+            await ctx.send(embed=embed)
+
+
+async def setup(bot):
+    await bot.add_cog(History())
@@ -1,39 +1,90 @@
-from datetime import datetime, timezone
-from typing import List, Tuple
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Set, Tuple
 
 import discord
-from discord.ext import tasks, commands
+from discord.ext import commands
 
 import codeforces
+import metrics
+import ratelimiter
 from database import User
 
+IDENTIFY_TIMEOUT = 60
+IDENTIFY_WINDOW = 5
+MIN_POLL_INTERVAL = 3
+MAX_POLL_INTERVAL = 12
+POLL_BACKOFF = 1.5
+
 
 def identified_required():
-    def predicate(ctx: commands.Context):
-        return User.find(ctx.author.id) is not None
+    async def predicate(ctx: commands.Context):
+        return await User.find(ctx.author.id) is not None
     return commands.check(predicate)
 
 
+@dataclass(eq=False)
+class PendingIdentify:
+    ctx: commands.Context
+    handle: str
+    expires_at: float
+    interval: float = MIN_POLL_INTERVAL
+
+
 class Identifier(commands.Cog):
     def __init__(self):
-        self.identify_list: List[Tuple[commands.Context, str]] = []
-        self.identify_loop.start()
+        self.pending: Dict[int, PendingIdentify] = {}
+        self.queue: List[Tuple[float, int, PendingIdentify]] = []
+        self.counter = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.checks: Set[asyncio.Task] = set()
+        self.identify_task: asyncio.Task | None = None
         self.identify_problem = codeforces.Problem(
             {'contestId': 4, 'index': 'A', 'name': 'Watermelon', 'rating': 800})
 
+    async def cog_load(self):
+        self.identify_task = asyncio.create_task(self.identify_loop())
+
+    async def cog_unload(self):
+        self.identify_task.cancel()
+
+    def schedule(self, pending: PendingIdentify, due: float):
+        heapq.heappush(self.queue, (due, next(self.counter), pending))
+        self.wakeup.set()
+
     @commands.command(name='identify')
     async def identify(self, ctx: commands.Context, handle: str):
-        user = User.find(ctx.author.id)
-        if User.find(ctx.author.id) is not None:
+        user = await User.find(ctx.author.id)
+        if user is not None:
             embed = discord.Embed(
                 description=f'You are already identified as {user.handle}', color=discord.Color.orange())
             return await ctx.send(embed=embed)
 
-        if any(pending[0].author.id == ctx.author.id for pending in self.identify_list):
+        if ctx.author.id in self.pending:
             return
 
-        await ctx.send(f'{ctx.author.mention} Please submit a compile error or runtime error in {self.identify_problem.url} within 60 seconds')
-        self.identify_list.append((ctx, handle))
+        try:
+            await codeforces.get_submissions(handle, count=1, priority=ratelimiter.INTERACTIVE)
+        except codeforces.InvalidHandleException:
+            embed = discord.Embed(
+                description=f'{handle} is not a valid Codeforces handle', color=discord.Color.orange())
+            return await ctx.send(embed=embed)
+        except codeforces.CodeforcesError:
+            embed = discord.Embed(
+                description='Codeforces is unavailable right now, please try again later', color=discord.Color.orange())
+            return await ctx.send(embed=embed)
+
+        if ctx.author.id in self.pending:
+            return
+
+        await ctx.send(f'{ctx.author.mention} Please submit a compile error or runtime error in {self.identify_problem.url} within {IDENTIFY_TIMEOUT} seconds')
+        pending = PendingIdentify(ctx, handle, ctx.message.created_at.timestamp() + IDENTIFY_TIMEOUT)
+        self.pending[ctx.author.id] = pending
+        self.schedule(pending, time.time() + pending.interval)
 
     @identify.error
     async def identify_error(self, ctx: commands.Context, error: commands.CommandError):
@@ -42,29 +93,70 @@ class Identifier(commands.Cog):
                 description='Please provide your Codeforces handle', color=discord.Color.orange())
             await ctx.send(embed=embed)
 
-    @tasks.loop(seconds=5)
+    def is_verified(self, pending: PendingIdentify, submissions: List[codeforces.Submission]):
+        message_time = pending.ctx.message.created_at.timestamp()
+        return any(submission.creation_time_seconds >= message_time and
+                   submission.problem_key == self.identify_problem.key and
+                   submission.verdict in ('COMPILATION_ERROR', 'RUNTIME_ERROR')
+                   for submission in submissions)
+
     async def identify_loop(self):
-        time = datetime.now(timezone.utc)
-        self.identify_list = [(ctx, handle) for ctx, handle in self.identify_list if (
-            time - ctx.message.created_at).total_seconds() <= 60]
-        new_identify_list = []
-        for ctx, handle in self.identify_list:
+        while True:
+            self.wakeup.clear()
+            if not self.queue:
+                await self.wakeup.wait()
+                continue
+
+            due, _, pending = self.queue[0]
+            delay = due - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self.queue)
+            check = asyncio.create_task(self.check(pending))
+            self.checks.add(check)
+            check.add_done_callback(self.checks.discard)
+
+    async def check(self, pending: PendingIdentify):
+        with metrics.timed('identify_loop.check'):
             try:
-                submissions = codeforces.get_submissions(handle, count=1)
-            except codeforces.InvalidHandleException:
-                submissions = []
-            messsage_time = ctx.message.created_at
-            identified = False
-            if submissions:
-                submission = submissions[0]
-                if (datetime.fromtimestamp(submission.creation_time_seconds, timezone.utc) >= messsage_time and
-                        submission.problem == self.identify_problem and submission.verdict in ('COMPILATION_ERROR', 'RUNTIME_ERROR')):
-                    User.create(ctx.author.id, handle)
-                    identified = True
-                    await ctx.send(f'{ctx.author.mention} has successfully identified as {handle}')
-            if not identified:
-                new_identify_list.append((ctx, handle))
-        self.identify_list = new_identify_list
+                await self.verify(pending)
+            except Exception:
+                logging.exception('Failed to check identify of %s', pending.handle)
+                # Never leave the entry behind unscheduled, or identify ignores the user for good.
+                if self.pending.get(pending.ctx.author.id) is not pending:
+                    return
+                now = time.time()
+                if now >= pending.expires_at:
+                    del self.pending[pending.ctx.author.id]
+                else:
+                    self.schedule(pending, min(now + pending.interval, pending.expires_at))
+
+    async def verify(self, pending: PendingIdentify):
+        ctx = pending.ctx
+        try:
+            submissions = await codeforces.get_submissions(
+                pending.handle, count=IDENTIFY_WINDOW, priority=ratelimiter.INTERACTIVE)
+        except (codeforces.InvalidHandleException, codeforces.CodeforcesError) as exc:
+            logging.warning('Failed to poll identify of %s: %r', pending.handle, exc)
+            submissions = []
+
+        if self.is_verified(pending, submissions):
+            del self.pending[ctx.author.id]
+            await User.create(ctx.author.id, pending.handle)
+            return await ctx.send(f'{ctx.author.mention} has successfully identified as {pending.handle}')
+
+        now = time.time()
+        if now >= pending.expires_at:
+            del self.pending[ctx.author.id]
+            return await ctx.send(f'{ctx.author.mention} Identification as {pending.handle} timed out, please try again')
+
+        pending.interval = min(pending.interval * POLL_BACKOFF, MAX_POLL_INTERVAL)
+        self.schedule(pending, min(now + pending.interval, pending.expires_at))
 
 
 async def setup(bot):
@@ -0,0 +1,135 @@
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import database as db
+import metrics
+import themecp
+from config import DATA_FOLDER
+
+FLUSH_INTERVAL = 5
+
+
+def get_performance(contest: db.VirtualContest):
+    return int(themecp.compute_performance(
+        contest.level, [problem.problem_info.rating for problem in contest.problems], contest.get_penalties()))
+
+
+class EventJournal:
+    def __init__(self, path: Path = DATA_FOLDER.joinpath('journal.jsonl')):
+        self.path = path
+        self.solves: Dict[int, datetime] = {}
+        self.finishes: Dict[int, dict] = {}
+        self.lock = asyncio.Lock()
+        # Serializes appends with rewrites, which both run their file I/O in a worker thread.
+        self.io_lock = asyncio.Lock()
+        self.file = None
+
+    @property
+    def pending(self):
+        return len(self.solves) + len(self.finishes)
+
+    def open(self):
+        try:
+            with open(self.path, 'r') as f:
+                for line in f:
+                    try:
+                        self.replay(json.loads(line))
+                    except (ValueError, KeyError):
+                        logging.warning('Skipping corrupt journal entry %r', line)
+        except FileNotFoundError:
+            pass
+        if self.pending:
+            logging.info('Replayed %d pending events from %s', self.pending, self.path)
+        self.file = open(self.path, 'a')
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def replay(self, event: dict):
+        if event['type'] == 'solve':
+            self.solves[event['problem_id']] = datetime.fromisoformat(event['date_solved'])
+        elif event['type'] == 'finish':
+            self.finishes[event['virtual_contest_id']] = {
+                'type': 'finish', 'virtual_contest_id': event['virtual_contest_id'], 'user_id': event['user_id'],
+                'penalties': event['penalties'], 'performance': event['performance']}
+
+    def write(self, lines: List[str]):
+        self.file.writelines(lines)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    async def append(self, events: List[dict]):
+        async with self.io_lock:
+            await asyncio.to_thread(self.write, [json.dumps(event) + '\n' for event in events])
+            for event in events:
+                self.replay(event)
+
+    async def record_solves(self, solves: List[Tuple[db.Problem, datetime]]):
+        await self.append([{'type': 'solve', 'problem_id': problem.problem_id,
+                            'date_solved': date_solved.isoformat()}
+                           for problem, date_solved in solves])
+        for problem, date_solved in solves:
+            problem.date_solved = date_solved
+
+    async def record_finishes(self, contests: List[db.VirtualContest]):
+        await self.append([{'type': 'finish', 'virtual_contest_id': contest.virtual_contest_id,
+                            'user_id': contest.user_id, 'penalties': contest.get_penalties(),
+                            'performance': get_performance(contest)}
+                           for contest in contests])
+        for contest in contests:
+            contest.finished = True
+
+    def apply(self, contests: List[db.VirtualContest]):
+        contests = [contest for contest in contests if contest.virtual_contest_id not in self.finishes]
+        for contest in contests:
+            for problem in contest.problems:
+                if problem.date_solved is None and problem.problem_id in self.solves:
+                    problem.date_solved = self.solves[problem.problem_id]
+        return contests
+
+    def replace(self, lines: List[str]):
+        self.close()
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as f:
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        tmp_path.replace(self.path)
+        self.file = open(self.path, 'a')
+
+    async def rewrite(self):
+        async with self.io_lock:
+            lines = [json.dumps({'type': 'solve', 'problem_id': problem_id,
+                                 'date_solved': date_solved.isoformat()}) + '\n'
+                     for problem_id, date_solved in self.solves.items()]
+            lines.extend(json.dumps(finish) + '\n' for finish in self.finishes.values())
+            await asyncio.to_thread(self.replace, lines)
+
+    async def flush(self):
+        async with self.lock:
+            if not self.pending:
+                return
+            solves, finishes = dict(self.solves), dict(self.finishes)
+            await db.apply_events(solves, finishes)
+            metrics.increment('journal.flushed_events', len(solves) + len(finishes))
+            for problem_id in solves:
+                if self.solves.get(problem_id) == solves[problem_id]:
+                    del self.solves[problem_id]
+            for virtual_contest_id in finishes:
+                self.finishes.pop(virtual_contest_id, None)
+            await self.rewrite()
+
+    async def run(self, interval: float = FLUSH_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush()
+            except Exception:
+                logging.exception('Failed to flush journal')
@@ -0,0 +1,39 @@
+from array import array
+from collections import Counter
+
+from config import DATA_FOLDER
+
+LEVEL_COUNT = 109
+PROBLEMS_PER_LEVEL = 4
+
+
+def load_ratings(path=DATA_FOLDER.joinpath('problem_ratings.txt')):
+    ratings = array('H')
+    with open(path, 'r') as f:
+        lines = f.read().strip().splitlines()
+    if len(lines) != LEVEL_COUNT:
+        raise ValueError(f'{path} has {len(lines)} levels, expected {LEVEL_COUNT}')
+    for level, line in enumerate(lines, 1):
+        row = list(map(int, line.split()))
+        if len(row) != PROBLEMS_PER_LEVEL or row != sorted(row) or any(rating % 100 for rating in row):
+            raise ValueError(f'{path} has invalid ratings for level {level}: {line!r}')
+        ratings.extend(row)
+    return ratings
+
+
+_ratings = load_ratings()
+
+
+def is_valid(level: int):
+    return 1 <= level <= LEVEL_COUNT
+
+
+def get_ratings(level: int):
+    if not is_valid(level):
+        raise ValueError(f'Level must be between 1 and {LEVEL_COUNT}')
+    start = (level - 1) * PROBLEMS_PER_LEVEL
+    return tuple(_ratings[start:start + PROBLEMS_PER_LEVEL])
+
+
+def get_rating_counts(level: int):
+    return Counter(get_ratings(level))
@@ -1,28 +1,72 @@
 import asyncio
+import logging
+import sys
+import time
 import discord
 from discord.ext import commands
+import codeforces
 import config
+import database
+import metrics
+import problemset
 
 
+async def phase(name: str, coroutine):
+    start = time.perf_counter()
+    try:
+        return await coroutine
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.observe(f'startup.{name}', elapsed)
+        logging.info('startup: %s took %.2fs', name, elapsed)
 
-async def main():
-    intents = discord.Intents.default()
-    intents.message_content = True
-    bot = commands.Bot(command_prefix=config.COMMAND_PREFIX, intents=intents, help_command=None)
 
+async def warm_problemset():
+    try:
+        await problemset.cache.ensure_fresh()
+    except codeforces.CodeforcesError:
+        logging.warning('Starting without a problemset; it will be fetched on first use')
+
+
+async def load_extensions(bot: commands.Bot):
     await bot.load_extension('identifier')
     await bot.load_extension('tasker')
+    await bot.load_extension('history')
     await bot.load_extension('utils')
 
-    @bot.event
-    async def on_ready():
-        await bot.change_presence(activity=discord.Game(name=f'{config.COMMAND_PREFIX}help'))
 
+async def main():
     if config.TOKEN is None:
         raise ValueError('TOKEN is not found')
 
     discord.utils.setup_logging()
-    await bot.start(config.TOKEN)
+    start = time.perf_counter()
+    intents = discord.Intents.default()
+    intents.message_content = True
+    bot = commands.Bot(command_prefix=config.COMMAND_PREFIX, intents=intents, help_command=None)
+
+    @bot.event
+    async def on_ready():
+        await bot.change_presence(activity=discord.Game(name=f'{config.COMMAND_PREFIX}help'))
+
+    metrics.monitor.start()
+    try:
+        # The gateway login, schema check and cache warmup don't depend on each other.
+        await asyncio.gather(
+            phase('login', bot.login(config.TOKEN)),
+            phase('schema', database.init()),
+            phase('problemset', warm_problemset()))
+        await phase('extensions', load_extensions(bot))
+        logging.info('startup: ready to connect after %.2fs', time.perf_counter() - start)
+        await bot.connect()
+    finally:
+        await bot.close()
+        await codeforces.close()
+        await database.engine.dispose()
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    if '--checker' in sys.argv[1:]:
+        import worker
+        asyncio.run(worker.main())
+    else:
+        asyncio.run(main())
@@ -0,0 +1,95 @@
+import asyncio
+import bisect
+import logging
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from typing import Dict, List
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+STALL_THRESHOLD = 0.1
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, fraction: float):
+        rank = fraction * self.count
+        seen = 0
+        for bucket, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bucket
+        return self.max
+
+
+histograms: Dict[str, Histogram] = defaultdict(Histogram)
+counters: Counter = Counter()
+
+
+def observe(name: str, value: float):
+    histograms[name].observe(value)
+
+
+def increment(name: str, amount: int = 1):
+    counters[name] += amount
+
+
+@contextmanager
+def timed(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+class LoopLagMonitor:
+    def __init__(self, interval: float = 0.25, threshold: float = STALL_THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+        self.task: asyncio.Task | None = None
+
+    async def run(self):
+        while True:
+            expected = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - expected)
+            observe('event_loop.lag', lag)
+            if lag >= self.threshold:
+                increment('event_loop.stalls')
+                logging.warning('Event loop stalled for %.3fs', lag)
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+
+monitor = LoopLagMonitor()
+
+
+def render():
+    lines: List[str] = []
+    for name, histogram in sorted(histograms.items()):
+        average = histogram.total / histogram.count if histogram.count else 0.0
+        lines.append(f'{name}: n={histogram.count} avg={average * 1000:.1f}ms '
+                     f'p50<={histogram.percentile(0.5) * 1000:.0f}ms p99<={histogram.percentile(0.99) * 1000:.0f}ms '
+                     f'max={histogram.max * 1000:.1f}ms')
+    for name, count in sorted(counters.items()):
+        lines.append(f'{name}: {count}')
+    return '\n'.join(lines)
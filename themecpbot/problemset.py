@@ -0,0 +1,93 @@
+import asyncio
+import json
+import logging
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple
+
+import codeforces
+import ratelimiter
+from config import DATA_FOLDER
+
+CACHE_PATH = DATA_FOLDER.joinpath('problemset.json')
+CACHE_TTL = 6 * 60 * 60
+RETRY_INTERVAL = 5 * 60
+
+
+class ProblemsetCache:
+    def __init__(self, path: Path = CACHE_PATH, ttl: float = CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.index: Dict[Tuple[str, int], List[codeforces.Problem]] = {}
+        self.updated = 0.0
+        self.retry_at = 0.0
+        self.generation = 0
+        self.refreshing: asyncio.Task | None = None
+        self.loading: asyncio.Task | None = None
+
+    @property
+    def stale(self):
+        return time.time() - self.updated >= self.ttl and time.time() >= self.retry_at
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            self.build(map(codeforces.Problem, data['problems']))
+            self.updated = data['updated']
+        except (OSError, ValueError, KeyError):
+            return
+
+    def save(self, problems: List[codeforces.Problem]):
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({'updated': self.updated,
+                       'problems': [problem.to_json() for problem in problems]}, f)
+        tmp_path.replace(self.path)
+
+    def build(self, problems: Iterable[codeforces.Problem]):
+        index = defaultdict(list)
+        for problem in problems:
+            if problem.rating is None:
+                continue
+            for tag in problem.tags:
+                index[tag, problem.rating].append(problem)
+        self.index = dict(index)
+        self.generation += 1
+
+    async def refresh(self):
+        try:
+            problems = await codeforces.get_problemset(priority=ratelimiter.BACKGROUND)
+        except codeforces.CodeforcesError:
+            logging.exception('Failed to refresh problemset')
+            if not self.index:
+                raise
+            # Keep serving the stale index and try again later instead of on every lookup.
+            self.retry_at = time.time() + RETRY_INTERVAL
+            return
+        self.updated = time.time()
+        self.build(problems)
+        try:
+            await asyncio.to_thread(self.save, problems)
+        except OSError:
+            logging.exception('Failed to persist problemset to %s', self.path)
+        logging.info('problemset refreshed with %d problems', len(problems))
+
+    async def warm(self):
+        if self.loading is None:
+            self.loading = asyncio.create_task(asyncio.to_thread(self.load))
+        await asyncio.shield(self.loading)
+
+    async def ensure_fresh(self):
+        await self.warm()
+        if self.stale and (self.refreshing is None or self.refreshing.done()):
+            self.refreshing = asyncio.create_task(self.refresh())
+        if not self.index and self.refreshing is not None:
+            await asyncio.shield(self.refreshing)
+
+    def get(self, tag: str, rating: int):
+        return self.index.get((tag, rating), [])
+
+
+cache = ProblemsetCache()
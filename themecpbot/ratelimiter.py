@@ -0,0 +1,71 @@
+import asyncio
+import heapq
+import itertools
+import time
+from typing import List, Tuple
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+
+class RateLimiter:
+    def __init__(self, rate: float, capacity: int = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.waiters: List[Tuple[int, int, asyncio.Future, float]] = []
+        self.counter = itertools.count()
+        self.drainer: asyncio.Task | None = None
+        self.acquired = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @property
+    def queue_depth(self):
+        return sum(not future.done() for _, _, future, _ in self.waiters)
+
+    def stats(self):
+        return {
+            'queue_depth': self.queue_depth,
+            'acquired': self.acquired,
+            'average_wait': self.total_wait / self.acquired if self.acquired else 0.0,
+            'max_wait': self.max_wait,
+        }
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def record(self, enqueued: float):
+        wait = time.monotonic() - enqueued
+        self.acquired += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    async def acquire(self, priority: int = BACKGROUND):
+        self.refill()
+        if not self.waiters and self.tokens >= 1:
+            self.tokens -= 1
+            self.record(time.monotonic())
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.counter), future, time.monotonic()))
+        if self.drainer is None or self.drainer.done():
+            self.drainer = asyncio.create_task(self.drain())
+        await future
+
+    async def drain(self):
+        while self.waiters:
+            self.refill()
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                continue
+            _, _, future, enqueued = heapq.heappop(self.waiters)
+            if future.done():
+                continue
+            self.tokens -= 1
+            self.record(enqueued)
+            future.set_result(None)
@@ -0,0 +1,71 @@
+import logging
+from typing import Awaitable, Callable, List
+
+import codeforces
+import database as db
+import ratelimiter
+
+PAGE_SIZE = 50
+CONTEST_PAGE_SIZE = 200
+
+
+async def paginate(fetch_page: Callable[[int, int], Awaitable[List[codeforces.Submission]]],
+                   last_submission_id: int, since: int = None, page_size: int = PAGE_SIZE):
+    submissions: List[codeforces.Submission] = []
+    start, pages = 1, 0
+    while True:
+        page = await fetch_page(page_size, start)
+        pages += 1
+        for submission in page:
+            if submission.submission_id <= last_submission_id or \
+                    (since is not None and submission.creation_time_seconds < since):
+                return submissions, pages
+            submissions.append(submission)
+        if len(page) < page_size:
+            return submissions, pages
+        start += page_size
+
+
+async def fetch_new_submissions(handle: str, last_submission_id: int, since: int = None,
+                                priority: int = ratelimiter.INTERACTIVE):
+    if last_submission_id == 0 and since is None:
+        return await codeforces.get_submissions(handle, priority=priority)
+
+    submissions, _ = await paginate(
+        lambda count, start: codeforces.get_submissions(handle, count=count, start=start, priority=priority),
+        last_submission_id, since)
+    return submissions
+
+
+async def fetch_new_contest_submissions(contest_id: int, last_submission_id: int, since: int,
+                                        priority: int = ratelimiter.BACKGROUND):
+    return await paginate(
+        lambda count, start: codeforces.get_contest_submissions(
+            contest_id, count=count, start=start, priority=priority),
+        last_submission_id, since, CONTEST_PAGE_SIZE)
+
+
+def next_watermark(submissions: List[codeforces.Submission], last_submission_id: int):
+    pending = [submission.submission_id for submission in submissions
+               if submission.verdict in (None, 'TESTING')]
+    if pending:
+        return max(last_submission_id, min(pending) - 1)
+    return max([last_submission_id] + [submission.submission_id for submission in submissions])
+
+
+async def get_solved_problems(handle: str):
+    last_submission_id, solved = await db.SolvedCache.get(handle)
+    try:
+        submissions = await fetch_new_submissions(handle, last_submission_id)
+    except codeforces.CodeforcesError:
+        if last_submission_id == 0:
+            raise
+        logging.warning('Using stale solved problems of %s', handle, exc_info=True)
+        return solved
+    if not submissions:
+        return solved
+
+    new_solved = {submission.problem_key for submission in submissions
+                  if submission.verdict == 'OK' and submission.contest_id is not None} - solved
+    await db.SolvedCache.update(handle, next_watermark(submissions, last_submission_id), new_solved)
+    return solved | new_solved
@@ -1,8 +1,13 @@
+import asyncio
 import codeforces
-from operator import attrgetter
+import levels
+import metrics
+import problemset
+import solved
 import random
-from typing import List
-from config import DATA_FOLDER
+from collections import OrderedDict
+from operator import attrgetter
+from typing import Callable, Dict, List, Set, Tuple
 from decimal import Decimal, ROUND_HALF_UP
 
 TAGS = ['implementation', 'math', 'brute force', 'constructive algorithms', 'greedy', 'sortings', 'dp', 'graphs', 'data structures',
@@ -13,48 +18,150 @@ class InvalidTagException(Exception):
     pass
 
 
-def choose_problems(handle: str, level: int, tag: str = None):
-    def get_problem_ratings():
-        with open(DATA_FOLDER.joinpath('problem_ratings.txt'), 'r') as f:
-            return list(map(int, f.readlines()[level - 1].split()))
-
-    def get_solved_problems():
-        submissions = codeforces.get_submissions(handle)
-        solved_problems = map(attrgetter('problem'), filter(
-            lambda sub: sub.verdict == 'OK', submissions))
-        return set(solved_problems)
-
-    def get_random_suggested_tag():
-        if level <= 25:
-            suggested_tags = ['implementation', 'math', 'brute force',
-                              'constructive algorithms', 'greedy', 'sortings']
-        elif level <= 40:
-            suggested_tags = ['brute force', 'math', 'constructive algorithms', 'graphs',
-                              'data structures', 'implementation', 'greedy', 'binary search', 'dp']
+MAX_RATING_FALLBACK = 300
+SAMPLE_ATTEMPTS = 8
+POOL_SIZE = 8
+MAX_POOLS = 256
+
+
+class NotEnoughProblemsException(Exception):
+    pass
+
+
+def get_suggested_tags(level: int):
+    if level <= 25:
+        return ['implementation', 'math', 'brute force',
+                'constructive algorithms', 'greedy', 'sortings']
+    elif level <= 40:
+        return ['brute force', 'math', 'constructive algorithms', 'graphs',
+                'data structures', 'implementation', 'greedy', 'binary search', 'dp']
+    else:
+        return ['brute force', 'math', 'constructive algorithms',
+                'graphs', 'bitmasks', 'data structures', 'implementation', 'trees']
+
+
+def get_fallback_ratings(rating: int):
+    yield rating
+    for delta in range(100, MAX_RATING_FALLBACK + 1, 100):
+        yield rating - delta
+        yield rating + delta
+
+
+def is_feasible(tag: str, level: int):
+    # Mirrors pick_problems: each rating draws from its nearest buckets first, sharing what is left.
+    remaining: Dict[int, int] = {}
+    for rating, count in sorted(levels.get_rating_counts(level).items()):
+        for fallback in get_fallback_ratings(rating):
+            available = remaining.setdefault(fallback, len(problemset.cache.get(tag, fallback)))
+            taken = min(count, available)
+            remaining[fallback] -= taken
+            count -= taken
+            if count == 0:
+                break
         else:
-            suggested_tags = ['brute force', 'math', 'constructive algorithms',
-                              'graphs', 'bitmasks', 'data structures', 'implementation', 'trees']
-        return random.choice(suggested_tags)
+            return False
+    return True
 
-    if tag is None:
-        tag = get_random_suggested_tag()
 
-    if tag not in TAGS:
+def sample_problem(bucket: List[codeforces.Problem], excluded: Callable[[codeforces.Problem], bool]):
+    if not bucket:
+        return None
+    for _ in range(SAMPLE_ATTEMPTS):
+        problem = random.choice(bucket)
+        if not excluded(problem):
+            return problem
+    choices = [problem for problem in bucket if not excluded(problem)]
+    return random.choice(choices) if choices else None
+
+
+def pick_problems(tag: str, level: int, solved_problems: Set[Tuple[int, str]]):
+    taken: List[codeforces.Problem] = []
+    taken_keys = set()
+
+    def excluded(problem: codeforces.Problem):
+        return problem.key in solved_problems or problem.key in taken_keys
+
+    for rating in levels.get_ratings(level):
+        problem = next(filter(None, (sample_problem(problemset.cache.get(tag, fallback), excluded)
+                                     for fallback in get_fallback_ratings(rating))), None)
+        if problem is None:
+            return None
+        taken.append(problem)
+        taken_keys.add(problem.key)
+    return sorted(taken, key=attrgetter('rating'))
+
+
+class ContestPools:
+    # Keeps a few problem sets picked ahead of time for recently requested (level, tag) pairs,
+    # so a start only has to find one that avoids the user's solved problems.
+    def __init__(self, size: int = POOL_SIZE, max_pools: int = MAX_POOLS):
+        self.size = size
+        self.max_pools = max_pools
+        self.pools: OrderedDict[Tuple[int, str], List[List[codeforces.Problem]]] = OrderedDict()
+        self.source = None
+        self.refilling: asyncio.Task | None = None
+
+    def check_source(self):
+        source = problemset.cache, problemset.cache.generation
+        if self.source != source:
+            self.pools = OrderedDict((key, []) for key in self.pools)
+            self.source = source
+
+    def take(self, tag: str, level: int, solved_problems: Set[Tuple[int, str]]):
+        self.check_source()
+        pool = self.pools.setdefault((level, tag), [])
+        self.pools.move_to_end((level, tag))
+        while len(self.pools) > self.max_pools:
+            self.pools.popitem(last=False)
+        self.schedule_refill()
+        for i, problems in enumerate(pool):
+            if not any(problem.key in solved_problems for problem in problems):
+                metrics.increment('contest_pool.hits')
+                return pool.pop(i)
+        metrics.increment('contest_pool.misses')
+        return None
+
+    async def refill(self):
+        self.check_source()
+        for (level, tag), pool in list(self.pools.items()):
+            while len(pool) < self.size:
+                problems = pick_problems(tag, level, set())
+                if problems is None:
+                    break
+                pool.append(problems)
+            await asyncio.sleep(0)
+
+    def schedule_refill(self):
+        if self.refilling is None or self.refilling.done():
+            self.refilling = asyncio.create_task(self.refill())
+
+
+pools = ContestPools()
+
+
+async def choose_problems(handle: str, level: int, tag: str = None):
+    if tag is None:
+        suggested_tags = get_suggested_tags(level)
+        offset = random.randrange(len(suggested_tags))
+        candidate_tags = suggested_tags[offset:] + suggested_tags[:offset]
+    elif tag in TAGS:
+        candidate_tags = [tag]
+    else:
         raise InvalidTagException()
 
-    problem_set = codeforces.get_problemset(tag)
-    solved_problems = get_solved_problems()
+    await problemset.cache.ensure_fresh()
+    candidate_tags = [candidate for candidate in candidate_tags if is_feasible(candidate, level)]
+    if not candidate_tags:
+        raise NotEnoughProblemsException()
 
-    unsolved_problems = list(
-        filter(lambda problem: problem not in solved_problems, problem_set))
+    solved_problems = await solved.get_solved_problems(handle)
+    for candidate in candidate_tags:
+        problems = pools.take(candidate, level, solved_problems) or \
+            pick_problems(candidate, level, solved_problems)
+        if problems is not None:
+            return candidate, problems
+    raise NotEnoughProblemsException()
 
-    taken: List[codeforces.Problem] = []
-    for rating in get_problem_ratings():
-        choices = list(filter(lambda problem: problem.rating ==
-                       rating and problem not in taken, unsolved_problems))
-        assert choices
-        taken.append(random.choice(choices))
-    return tag, taken
 
 def compute_performance(level: int, ratings: List[int], penalties: List[int]):
     assert len(penalties) == len(ratings) == 4
@@ -72,3 +179,18 @@ def compute_performance(level: int, ratings: List[int], penalties: List[int]):
             (120 - penalties[num_solved - 1]) / 120 * (ratings[3] + 400)
 
     return Decimal(ret + (level - 1) % 4 * 12.5).to_integral_value(rounding=ROUND_HALF_UP)
+
+
+def compute_performances(levels: List[int], ratings: List[List[int]], penalties: List[List[int]]):
+    import numpy as np
+    levels, ratings, penalties = np.asarray(levels), np.asarray(ratings), np.asarray(penalties)
+    num_solved = np.cumprod(penalties != -1, axis=1).sum(axis=1)
+    last_solved = np.clip(num_solved - 1, 0, 3)[:, None]
+    penalty = np.take_along_axis(penalties, last_solved, axis=1)[:, 0]
+    lower = np.take_along_axis(ratings, last_solved, axis=1)[:, 0]
+    upper = np.where(num_solved == 4, ratings[:, 3] + 400,
+                     np.take_along_axis(ratings, np.clip(num_solved, 0, 3)[:, None], axis=1)[:, 0])
+
+    ret = np.where(num_solved == 0, ratings[:, 0] - 50,
+                   penalty / 120 * lower + (120 - penalty) / 120 * upper)
+    return np.floor(ret + (levels - 1) % 4 * 12.5 + 0.5).astype(np.int64)
@@ -1,5 +1,7 @@
 from discord.ext import commands
 from config import COMMAND_PREFIX
+import codeforces
+import metrics
 
 help_message = f"""
 identify <handle> - Set your Codeforces handle
@@ -12,6 +14,8 @@ Examples:
     {COMMAND_PREFIX}start 2 math
 
 quit - Quit the ongoing ThemeCP
+history - Show your recent ThemeCP results
+leaderboard - Show the top performers in this server
 help - Show this message
 """
 
@@ -20,6 +24,21 @@ class Utils(commands.Cog):
     async def help(self, ctx: commands.Context):
         await ctx.send(f'```{help_message}```')
 
+    @commands.command(name='stats')
+    @commands.is_owner()
+    async def stats(self, ctx: commands.Context):
+        limiter = codeforces.limiter.stats()
+        limiter_stats = ' '.join(f'{key}={value:.3f}' if isinstance(value, float) else f'{key}={value}'
+                                 for key, value in limiter.items())
+        lines = metrics.render().splitlines() + [f'rate_limiter: {limiter_stats}']
+        chunk = []
+        for line in lines:
+            if sum(map(len, chunk)) + len(chunk) + len(line) > 1900:
+                await ctx.send('```{}```'.format('\n'.join(chunk)))
+                chunk = []
+            chunk.append(line)
+        await ctx.send('```{}```'.format('\n'.join(chunk)))
+
 
 async def setup(bot):
     await bot.add_cog(Utils())
\ No newline at end of file
@@ -0,0 +1,98 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+from datetime import timedelta
+from typing import Dict, Set
+
+import discord
+
+import checker
+import codeforces
+import database as db
+import metrics
+from announcer import Announcer
+from config import CHECKER_SHARDS, DATA_FOLDER, TOKEN
+from journal import EventJournal
+
+LEASE_DURATION = timedelta(seconds=checker.TICK_INTERVAL * 4)
+RENEW_INTERVAL = checker.TICK_INTERVAL
+
+
+class Leases:
+    # Renewed in the background so a tick that outlasts LEASE_DURATION keeps its shards.
+    def __init__(self, owner: str):
+        self.owner = owner
+        self.shards: Set[int] = set()
+        self.valid_until = 0.0
+
+    def holds(self, shard: int):
+        return shard in self.shards and time.monotonic() < self.valid_until
+
+    async def renew(self):
+        started = time.monotonic()
+        shards = await db.CheckerLease.acquire(self.owner, CHECKER_SHARDS, LEASE_DURATION)
+        self.valid_until = started + LEASE_DURATION.total_seconds()
+        if shards != self.shards:
+            logging.info('%s now owns checker shards %s of %d', self.owner, sorted(shards), CHECKER_SHARDS)
+        self.shards = shards
+
+    async def run(self):
+        while True:
+            try:
+                await self.renew()
+            except Exception:
+                logging.exception('Failed to renew checker leases')
+            await asyncio.sleep(RENEW_INTERVAL)
+
+
+async def run_checker(announcer: Announcer, journal: EventJournal, leases: Leases):
+    checkers: Dict[int, checker.SolvedChecker] = {}
+
+    async def check(solved_checker: checker.SolvedChecker):
+        try:
+            await solved_checker.check(announcer, lambda: leases.holds(solved_checker.shard))
+        except Exception:
+            logging.exception('Checker shard %d failed', solved_checker.shard)
+
+    while True:
+        for shard in checkers.keys() - leases.shards:
+            del checkers[shard]
+        for shard in leases.shards - checkers.keys():
+            checkers[shard] = checker.SolvedChecker(journal, shard, CHECKER_SHARDS)
+        await asyncio.gather(*(check(solved_checker) for shard, solved_checker in checkers.items()
+                               if leases.holds(shard)))
+        await asyncio.sleep(checker.TICK_INTERVAL)
+
+
+async def main():
+    if CHECKER_SHARDS < 1:
+        raise ValueError('CHECKER_SHARDS must be at least 1 to run a checker worker')
+    if TOKEN is None:
+        raise ValueError('TOKEN is not found')
+
+    discord.utils.setup_logging()
+    await db.init()
+    metrics.monitor.start()
+
+    owner = f'{socket.gethostname()}:{os.getpid()}'
+    journal = EventJournal(DATA_FOLDER.joinpath(f"journal-{os.environ.get('DYNO', 'checker')}.jsonl"))
+    journal.open()
+    flusher = asyncio.create_task(journal.run())
+    client = discord.Client(intents=discord.Intents.none())
+    await client.login(TOKEN)
+    leases = Leases(owner)
+    await leases.renew()
+    renewer = asyncio.create_task(leases.run())
+    try:
+        await run_checker(Announcer(client), journal, leases)
+    finally:
+        renewer.cancel()
+        flusher.cancel()
+        await journal.flush()
+        journal.close()
+        await db.CheckerLease.release(owner)
+        await client.close()
+        await codeforces.close()
+        await db.engine.dispose()